@@ -1,74 +1,172 @@
+import json
+import os
+import sys
 import pandas as pd
 import numpy as np
 from enum import Enum
+from functools import cached_property
+
+# The compiled kernels live in their own module so numba can cache them under a stable module name however
+# this file is loaded (as a script, or through runpy/importlib under any name); make sure it is importable
+# when this file is loaded from another directory
+_HERE = os.path.dirname(os.path.abspath(__file__))
+if _HERE not in sys.path:
+    sys.path.insert(0, _HERE)
+from backtest_kernels import WeightScheme, stocks_from_threshold, portfolio_weights, turnover, weights_and_turnover
 
 class RebalancePeriod(Enum):
     MONTHLY = 1
     QUARTERLY = 3
 
+# Scheme names accepted by the backtester, exactly as written: 'equal', 'market_cap', 'market_cap_momentum'
+_WEIGHT_SCHEMES = {scheme.name.lower(): scheme for scheme in WeightScheme}
+
+def _as_matrix(df, tickers):
+    """Row-major (months x tickers) float64 matrix, so each month's values are contiguous in memory."""
+    return np.ascontiguousarray(df[tickers].to_numpy(dtype=np.float64))
+
+def _mapped_matrix(npy_file):
+    """Read-only memory map of a cached matrix as a plain ndarray."""
+    # Every row or fancy index of an np.memmap builds another memmap object, roughly 1 us of overhead
+    # per access; a base-class view over the same mapping indexes like any other array
+    return np.asarray(np.load(npy_file, mmap_mode='r'))
+
+def _load_matrix(csv_file):
+    """Load a data file as (tickers, months x tickers matrix), memory-mapping a cached .npy copy when it is up to date."""
+    npy_file = csv_file + '.npy'
+    meta_file = csv_file + '.json'
+    source_mtime = os.path.getmtime(csv_file)
+    
+    # The sidecar holds the ticker columns and the CSV modification time the cache was built from;
+    # a cache that cannot be read back is treated as missing and rebuilt from the CSV
+    if os.path.exists(npy_file) and os.path.exists(meta_file):
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta['source_mtime'] == source_mtime:
+                return np.array(meta['tickers']), _mapped_matrix(npy_file)
+        except (OSError, EOFError, ValueError, KeyError):
+            pass
+    
+    df = pd.read_csv(csv_file)
+    tickers = np.array(df.columns[1:])
+    matrix = _as_matrix(df, tickers)
+    
+    # Write both files under per-process temporary names and move them into place, data before sidecar,
+    # so an interrupted or concurrent first run never leaves a sidecar pointing at a partial .npy
+    npy_tmp = f'{npy_file}.{os.getpid()}.tmp'
+    meta_tmp = f'{meta_file}.{os.getpid()}.tmp'
+    try:
+        with open(npy_tmp, 'wb') as f:
+            np.save(f, matrix)
+        with open(meta_tmp, 'w') as f:
+            json.dump({'tickers': tickers.tolist(), 'source_mtime': source_mtime}, f)
+        os.replace(npy_tmp, npy_file)
+        os.replace(meta_tmp, meta_file)
+    except OSError:
+        # Caching is only an optimisation, e.g. the data directory may be read-only
+        for tmp_file in (npy_tmp, meta_tmp):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return tickers, matrix
+    return tickers, _mapped_matrix(npy_file)
+
+def _select_top_stocks(mom_rank, rows, n):
+    """Column indices of the top n momentum stocks for each of the given rows, as an (R x n) int32 array sorted by column."""
+    # Asking for more stocks than there are simply selects all of them
+    if n < 1:
+        raise ValueError("Number of stocks must be at least 1")
+    n = min(n, mom_rank.shape[1])
+    ranked = mom_rank[rows]
+    thresholds = np.partition(ranked, -n, axis=1)[:, -n]
+    return stocks_from_threshold(ranked, thresholds, n)
+
+def _portfolio_returns(ret_filled, idx_all, w_all, start, end, freq):
+    """Monthly returns for every month in [start, end), each month holding the portfolio of its rebalance period."""
+    # (periods x months per period) grid of return rows; a short final period is padded here and trimmed below
+    months = start + np.arange(idx_all.shape[0] * freq).reshape(-1, freq)
+    rows = np.minimum(months + 1, end)
+    
+    # Broadcast each period's portfolio over its months rather than repeating it per month
+    held_returns = ret_filled[rows[:, :, np.newaxis], idx_all[:, np.newaxis, :]]
+    
+    # Missing weights contribute nothing, like a NaN-skipping sum; both operands are contiguous float64
+    # so the batched product runs as a BLAS-style dot per month
+    period_returns = np.matmul(held_returns, np.nan_to_num(w_all)[:, :, np.newaxis])[:, :, 0]
+    return period_returns.ravel()[:end - start]
+
+
 class PortfolioBacktester:
     def __init__(self, returns_file, momentum_file, market_cap_file):
         """Initialize the backtester with data files."""
-        self.monthly_returns_df = pd.read_csv(returns_file)
-        self.momentum_df = pd.read_csv(momentum_file)
-        self.market_cap_df = pd.read_csv(market_cap_file)
+        self.returns_file = returns_file
+        self.momentum_file = momentum_file
+        self.market_cap_file = market_cap_file
+        
+        # Load each file as a (months x tickers) matrix with columns aligned to the returns tickers;
+        # stocks are referred to by column index from here on
+        self.tickers, self.ret_mat = _load_matrix(returns_file)
+        self.n_tickers = len(self.tickers)
+        self.mom_mat = self._align_columns(*_load_matrix(momentum_file))
+        self.mcap_mat = self._align_columns(*_load_matrix(market_cap_file))
+        
+        # Momentum with missing scores ranked last and returns with missing values as 0,
+        # computed once and shared by every backtest
+        self._mom_rank = np.where(np.isnan(self.mom_mat), -np.inf, self.mom_mat)
+        self._ret_filled = np.where(np.isnan(self.ret_mat), 0.0, self.ret_mat)
+        
+    @cached_property
+    def monthly_returns_df(self):
+        """Monthly returns table, read from the CSV on first access."""
+        return pd.read_csv(self.returns_file)
+    
+    @cached_property
+    def momentum_df(self):
+        """Momentum table, read from the CSV on first access."""
+        return pd.read_csv(self.momentum_file)
+    
+    @cached_property
+    def market_cap_df(self):
+        """Market cap table, read from the CSV on first access."""
+        return pd.read_csv(self.market_cap_file)
+    
+    def _align_columns(self, tickers, matrix):
+        """Reorder a matrix's columns to match the returns tickers."""
+        if np.array_equal(tickers, self.tickers):
+            return matrix
+        
+        ticker_to_col = {ticker: col for col, ticker in enumerate(tickers)}
+        return np.ascontiguousarray(matrix[:, [ticker_to_col[ticker] for ticker in self.tickers]])
         
     def select_top_stocks(self, date_index, n):
-        """Select top n stocks based on momentum for given date."""
-        month_returns = self.momentum_df.iloc[date_index]
-        month_returns = month_returns.drop(month_returns.index[0])
-        top_stocks = month_returns.nlargest(n)
+        """Select top n stocks based on momentum for given date, returned as (column indices, momentum factors)."""
+        momentum = self.mom_mat[date_index]
+        top_stocks = _select_top_stocks(self._mom_rank, [date_index], n)[0]
+        
+        # Order by descending momentum; any stocks without a momentum score come last
+        top_stocks = top_stocks[np.argsort(-momentum[top_stocks], kind='stable')]
         
-        return pd.DataFrame({'Stock': top_stocks.index, 'Momentum Factor': top_stocks.values})
+        return top_stocks, momentum[top_stocks]
     
+    def stock_names(self, top_stocks):
+        """Convert column indices to ticker symbols for display."""
+        return self.tickers[top_stocks]
     
-    def calculate_portfolio_weights(self, top_stocks_df, weight_scheme, month_index):
+    
+    def calculate_portfolio_weights(self, top_stocks, momentum_factors, weight_scheme, month_index):
         """Calculate portfolio weights based on selected scheme."""
-        if weight_scheme == 'equal':
-            return self._equal_weight(top_stocks_df)
-        elif weight_scheme == 'market_cap':
-            return self._market_cap_weight(top_stocks_df, month_index)
-        elif weight_scheme == 'market_cap_momentum':
-            return self._market_cap_momentum_weight(top_stocks_df, month_index)
-        else:
-            raise ValueError("Invalid weight scheme. Choose 'equal', 'market_cap', or 'market_cap_momentum'")
-    
-    def _equal_weight(self, top_stocks_df):
-        """Calculate equal weights for portfolio."""
-        weight = 1 / len(top_stocks_df)
-        top_stocks_df['Weight'] = weight
-        return top_stocks_df
-    
-    def _market_cap_weight(self, top_stocks_df, month_index):
-        """Calculate market cap weighted portfolio."""
-        stocks = top_stocks_df['Stock'].tolist()
-        market_caps = self.market_cap_df.iloc[month_index][stocks]
-        total_market_cap = market_caps.sum()
-        
-        if total_market_cap == 0:
-            top_stocks_df['Weight'] = float('nan')
-        else:
-            weights = market_caps / total_market_cap
-            top_stocks_df['Weight'] = top_stocks_df['Stock'].map(weights)
-            
-        return top_stocks_df
-    
-    def _market_cap_momentum_weight(self, top_stocks_df, month_index):
-        """Calculate market cap * momentum weighted portfolio."""
-        stocks = top_stocks_df['Stock'].tolist()
-        market_caps = self.market_cap_df.iloc[month_index][stocks]
-        momentum_factors = top_stocks_df.set_index('Stock')['Momentum Factor']
-        
-        mc_momentum_product = market_caps * momentum_factors
-        total_mc_momentum = mc_momentum_product.sum()
-        
-        if total_mc_momentum == 0:
-            top_stocks_df['Weight'] = float('nan')
-        else:
-            weights = mc_momentum_product / total_mc_momentum
-            top_stocks_df['Weight'] = top_stocks_df['Stock'].map(weights)
-            
-        return top_stocks_df
+        # Passed as a plain int, like run_backtest does, so both share one compiled specialisation
+        scheme = int(self._weight_scheme(weight_scheme))
+        rows = np.array([month_index])
+        return portfolio_weights(scheme, self.mcap_mat, rows, np.asarray(top_stocks)[np.newaxis], np.asarray(momentum_factors, dtype=np.float64)[np.newaxis])[0]
+    
+    def _weight_scheme(self, weight_scheme):
+        """Convert a weighting scheme name such as 'market_cap' to its WeightScheme."""
+        if isinstance(weight_scheme, WeightScheme):
+            return weight_scheme
+        if isinstance(weight_scheme, str) and weight_scheme in _WEIGHT_SCHEMES:
+            return _WEIGHT_SCHEMES[weight_scheme]
+        raise ValueError("Invalid weight scheme. Choose 'equal', 'market_cap', or 'market_cap_momentum'")
     
     
     def calculate_turnover(self, current_portfolio, previous_portfolio):
@@ -76,18 +174,23 @@ class PortfolioBacktester:
         if previous_portfolio is None:
             return np.nan
             
-        merged_portfolio = pd.merge(current_portfolio[['Stock', 'Weight']], previous_portfolio[['Stock', 'Weight']], on='Stock', how='outer', suffixes=('_current', '_previous'))
-        merged_portfolio.fillna(0, inplace=True)
-        weight_diff = abs(merged_portfolio['Weight_current'] - merged_portfolio['Weight_previous'])
+        current_stocks, current_weights = current_portfolio
+        previous_stocks, previous_weights = previous_portfolio
+        current_order = np.argsort(current_stocks)
+        previous_order = np.argsort(previous_stocks)
         
-        return weight_diff.sum() / 2
+        return turnover(current_stocks[current_order], current_weights[current_order], previous_stocks[previous_order], previous_weights[previous_order])
     
     def calculate_portfolio_return(self, portfolio, month):
         """Calculate portfolio return for given month."""
-        portfolio_stocks = portfolio['Stock'].values
-        portfolio_weights = portfolio['Weight'].values
-        month_returns = self.monthly_returns_df.iloc[month][portfolio_stocks]
-        return (month_returns * portfolio_weights).sum()
+        portfolio_stocks, portfolio_weights = portfolio
+        portfolio_weights = np.ascontiguousarray(portfolio_weights, dtype=np.float64)
+        portfolio_return = np.dot(self._ret_filled[month, portfolio_stocks], portfolio_weights)
+        
+        # Only portfolios with missing weights need the slower NaN-skipping sum
+        if np.isnan(portfolio_return):
+            portfolio_return = np.nansum(self._ret_filled[month, portfolio_stocks] * portfolio_weights)
+        return portfolio_return
     
     
     def run_backtest(self, num_stocks, weight_scheme, rebalance_period=RebalancePeriod.QUARTERLY, start_month=15, end_month=59):
@@ -98,7 +201,7 @@ class PortfolioBacktester:
         -----------
         num_stocks : int
             Number of stocks to include in the portfolio
-        weight_scheme : str
+        weight_scheme : str or WeightScheme
             Weighting scheme ('equal', 'market_cap', or 'market_cap_momentum')
         rebalance_period : RebalancePeriod
             RebalancePeriod.MONTHLY or RebalancePeriod.QUARTERLY
@@ -107,48 +210,40 @@ class PortfolioBacktester:
         end_month : int
             Ending month index for the backtest
         """
-        monthly_returns = []
-        monthly_turnover = []
-        previous_portfolio = None
+        weight_scheme = self._weight_scheme(weight_scheme)
         rebalance_freq = rebalance_period.value
         
-        # Determine rebalancing months
-        rebalance_months = range(start_month, end_month, rebalance_freq)
+        # Select the portfolios for every rebalance date in one batch
+        rebalance_months = np.arange(start_month, end_month, rebalance_freq)
+        idx_all = _select_top_stocks(self._mom_rank, rebalance_months, num_stocks)
+        momentum_factors = np.take_along_axis(self.mom_mat[rebalance_months], idx_all, axis=1)
         
-        for period_start in rebalance_months:
-            # Select and weight portfolio at start of period
-            top_stocks = self.select_top_stocks(period_start, num_stocks)
-            current_portfolio = self.calculate_portfolio_weights(top_stocks, weight_scheme, period_start)
-            
-            # Calculate returns and turnover for each month until next rebalance
-            for month in range(period_start, min(period_start + rebalance_freq, end_month)):
-                monthly_return = self.calculate_portfolio_return(current_portfolio, month + 1)
-                turnover = self.calculate_turnover(current_portfolio, previous_portfolio)
-                
-                monthly_returns.append(monthly_return)
-                monthly_turnover.append(turnover)
-                
-                previous_portfolio = current_portfolio.copy()
+        # Weight them and compute turnover; the scheme goes in as a plain int, one compiled specialisation for all
+        w_all, monthly_turnover = weights_and_turnover(int(weight_scheme), self.mcap_mat, rebalance_months, idx_all, momentum_factors, start_month, end_month, rebalance_freq)
+        monthly_returns = _portfolio_returns(self._ret_filled, idx_all, w_all, start_month, end_month, rebalance_freq)
         
         return self.calculate_metrics(monthly_returns, monthly_turnover)
     
     
     def calculate_metrics(self, monthly_returns, monthly_turnover):
         """Calculate portfolio performance metrics."""
-        returns_df = pd.DataFrame(monthly_returns, columns=['Monthly Return'])
-        turnover_df = pd.DataFrame(monthly_turnover, columns=['Monthly Turnover'])
+        monthly_returns = np.asarray(monthly_returns, dtype=np.float64)
+        monthly_turnover = np.asarray(monthly_turnover, dtype=np.float64)
+        
+        # Accumulate growth as a running sum of log returns, which cannot under/overflow like a long product
+        log_growth = np.cumsum(np.log1p(monthly_returns))
+        cumulative_returns = np.expm1(log_growth)
         
-        # Calculate CAGR
-        total_return = (1 + returns_df['Monthly Return']).prod()
-        n_years = len(returns_df) / 12
-        cagr = total_return ** (1 / n_years) - 1
+        # Calculate CAGR from the total growth at the end of the series
+        n_years = len(monthly_returns) / 12
+        cagr = np.expm1(log_growth[-1] / n_years)
         
-        # Calculate other metrics
-        annual_std = returns_df['Monthly Return'].std() * np.sqrt(12)
-        annual_turnover = pd.Series(monthly_turnover).mean() * 12
+        # Calculate other metrics (the first month has no turnover)
+        annual_std = monthly_returns.std(ddof=1) * np.sqrt(12)
+        annual_turnover = np.nanmean(monthly_turnover) * 12
         sharpe_ratio = (cagr - 0.0385) / annual_std
         
-        return {'CAGR': cagr, 'Annual Std Dev': annual_std, 'Annual Turnover': annual_turnover, 'Sharpe Ratio': sharpe_ratio, 'Monthly Returns': returns_df, 'Monthly Turnover': turnover_df}
+        return {'CAGR': cagr, 'Annual Std Dev': annual_std, 'Annual Turnover': annual_turnover, 'Sharpe Ratio': sharpe_ratio, 'Monthly Returns': monthly_returns, 'Cumulative Returns': cumulative_returns, 'Monthly Turnover': monthly_turnover}
 
 def main():
     """Main function to run the backtester."""
@@ -0,0 +1,115 @@
+"""Compiled kernels for the momentum portfolio backtester."""
+import numpy as np
+from enum import IntEnum
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Fallback when numba is not installed: run the kernels as plain Python."""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+class WeightScheme(IntEnum):
+    EQUAL = 0
+    MARKET_CAP = 1
+    MARKET_CAP_MOMENTUM = 2
+
+@njit(cache=True)
+def stocks_from_threshold(ranked, thresholds, n):
+    """Take every stock above a row's n-th largest score, then the first stocks tied at it, in column order."""
+    # Keeping the first of the tied stocks matches nlargest, which matters for a month with fewer than n
+    # scores: it is padded with the first unscored stocks
+    top_stocks = np.empty((ranked.shape[0], n), dtype=np.int32)
+    for r in range(ranked.shape[0]):
+        tied_left = n
+        for col in range(ranked.shape[1]):
+            if ranked[r, col] > thresholds[r]:
+                tied_left -= 1
+        
+        k = 0
+        for col in range(ranked.shape[1]):
+            if k == n:
+                break
+            if ranked[r, col] > thresholds[r]:
+                top_stocks[r, k] = col
+                k += 1
+            elif ranked[r, col] == thresholds[r] and tied_left > 0:
+                top_stocks[r, k] = col
+                k += 1
+                tied_left -= 1
+    return top_stocks
+
+@njit(cache=True, nogil=True)
+def portfolio_weights(scheme, mcap_mat, rows, idx_all, momentum_factors):
+    """Row-wise portfolio weights for the given scheme; a stock whose weight is missing is left out of the total."""
+    n_rows, n = idx_all.shape
+    weights = np.empty((n_rows, n))
+    
+    # Gather, weight and total each portfolio in a single pass, then normalise it in place
+    for r in range(n_rows):
+        total = 0.0
+        for k in range(n):
+            if scheme == WeightScheme.EQUAL:
+                weight = 1.0
+            elif scheme == WeightScheme.MARKET_CAP:
+                weight = mcap_mat[rows[r], idx_all[r, k]]
+            else:
+                weight = mcap_mat[rows[r], idx_all[r, k]] * momentum_factors[r, k]
+            weights[r, k] = weight
+            if not np.isnan(weight):
+                total += weight
+        
+        if total == 0:
+            weights[r] = np.nan
+        else:
+            weights[r] /= total
+    return weights
+
+@njit(cache=True)
+def _weight_or_zero(weight):
+    """Treat a missing weight as no holding."""
+    return 0.0 if np.isnan(weight) else weight
+
+@njit(cache=True)
+def turnover(current_idx, current_w, previous_idx, previous_w):
+    """Half the sum of absolute weight changes between two portfolios sorted by column index (missing weights count as 0)."""
+    total = 0.0
+    i = 0
+    j = 0
+    
+    # Two-pointer merge over the union of both sorted index arrays
+    while i < current_idx.shape[0] or j < previous_idx.shape[0]:
+        if j == previous_idx.shape[0] or (i < current_idx.shape[0] and current_idx[i] < previous_idx[j]):
+            total += abs(_weight_or_zero(current_w[i]))
+            i += 1
+        elif i == current_idx.shape[0] or previous_idx[j] < current_idx[i]:
+            total += abs(_weight_or_zero(previous_w[j]))
+            j += 1
+        else:
+            total += abs(_weight_or_zero(current_w[i]) - _weight_or_zero(previous_w[j]))
+            i += 1
+            j += 1
+    return total / 2
+
+@njit(cache=True, nogil=True)
+def monthly_turnover(idx_all, w_all, start, end, freq):
+    """Compiled month-by-month turnover over precomputed portfolios."""
+    monthlyturnover = np.zeros(end - start)
+    
+    for r in range(idx_all.shape[0]):
+        # Trading only happens at the rebalance; the first portfolio has nothing to compare against,
+        # and the remaining months of each period keep their zero turnover
+        if r == 0:
+            monthlyturnover[0] = np.nan
+        else:
+            monthlyturnover[r * freq] = turnover(idx_all[r], w_all[r], idx_all[r - 1], w_all[r - 1])
+    
+    return monthlyturnover
+
+@njit(cache=True, nogil=True)
+def weights_and_turnover(scheme, mcap_mat, rows, idx_all, momentum_factors, start, end, freq):
+    """Weight the precomputed portfolios and compute their monthly turnover in a single compiled call."""
+    w_all = portfolio_weights(scheme, mcap_mat, rows, idx_all, momentum_factors)
+    return w_all, monthly_turnover(idx_all, w_all, start, end, freq)
\ No newline at end of file